@@ -1,20 +1,25 @@
 #!/usr/bin/env python3
 
+import re
 import hashlib
 import time
 import argparse
+import threading
 import traceback
+import cProfile
+import pstats
+import collections
+import concurrent.futures
 
 import urllib3
 import requests
 import prometheus_client
+import prometheus_client.core
 import lxml.etree
 
 
-import xml.etree.ElementTree as ET
-
-
 PREFIX = 'msa_'
+NAN = float('nan')
 HOSTPORTSTATS_PROPERTIES_AS_LABEL_MAPPING = {'durable-id': 'port'}
 DISK_PROPERTIES_AS_LABEL_MAPPING = {'location': 'location',
                                     'serial-number': 'serial'}
@@ -148,7 +153,8 @@ METRICS = {
         'description': 'SSD Life Remaining',
         'sources': {
             'path': 'disks',
-            'object_selector': "./OBJECT[@name='drive']/PROPERTY[@name='architecture'][text()='SSD']/..",
+            'object_selector': "./OBJECT[@name='drive']",
+            'properties_filter': {'architecture': 'SSD'},
             'property_selector': './PROPERTY[@name="ssd-life-left-numeric"]',
             'properties_as_label': DISK_PROPERTIES_AS_LABEL_MAPPING
         }
@@ -790,77 +796,318 @@ METRICS = {
     },
 }
 
+METRIC_TYPES = {'gauge': prometheus_client.core.GaugeMetricFamily}
+
+# The MSA XML carries no useful IDs, entities or formatting whitespace
+PARSER_OPTIONS = dict(collect_ids=False, remove_blank_text=True, remove_comments=True, huge_tree=False, resolve_entities=False)
+PARSER = lxml.etree.XMLParser(**PARSER_OPTIONS)
+
+SIMPLE_PROPERTY_SELECTOR = re.compile(r'^\./PROPERTY\[@name=["\']([^"\']+)["\']\]$')
+SESSION_KEY_SELECTOR = lxml.etree.XPath('./OBJECT[@name="status"]/PROPERTY[@name="response"]/text()')
+STATUS_SELECTOR = lxml.etree.XPath('./OBJECT[@name="status"]/PROPERTY[@name="response-type-numeric"]/text()')
+VERSION_OBJECT_SELECTOR = lxml.etree.XPath('./OBJECT[@name=$name]')
+VERSION_PROPERTY_SELECTOR = lxml.etree.XPath('./PROPERTY[@name=$name]')
+VERSION_PROPERTIES = ["bundle-version", "bundle-base-version","sc-fw", "mc-fw", "pld-rev"]
+VERSION_LABEL_NAMES = ('controller',) + tuple(version.replace("-", "_") for version in VERSION_PROPERTIES)
+
+
+def compile_metrics(metrics):
+    """ Normalize metric sources to lists and compile their XPath selectors once.
+    """
+    # Many sources share selectors, compile each distinct expression only once
+    xpaths = {}
+
+    def compile_xpath(expression):
+        if expression not in xpaths:
+            xpaths[expression] = lxml.etree.XPath(expression)
+        return xpaths[expression]
+
+    for name, metric in metrics.items():
+        metric.setdefault('type', 'gauge')
+        if metric['type'] not in METRIC_TYPES:
+            raise RuntimeError('Unknown metric type "%s" for metric "%s"' % (metric['type'], name))
+        if isinstance(metric['sources'], dict):
+            metric['sources'] = [metric['sources']]
+        for source in metric['sources']:
+            source.setdefault('properties_as_label', {})
+            source.setdefault('labels', {})
+            source['properties_filter'] = tuple(source.get('properties_filter', {}).items())
+            source['label_names'] = tuple(source['properties_as_label'].values()) + tuple(source['labels'])
+            source['label_properties'] = tuple(source['properties_as_label'])
+            source['label_values'] = tuple(str(value) for value in source['labels'].values())
+            match = SIMPLE_PROPERTY_SELECTOR.match(source['property_selector'])
+            source['object_selector'] = compile_xpath(source['object_selector'])
+            if match:
+                source['property_name'] = match.group(1)
+                source['property_selector'] = None
+            else:
+                # number() converts in libxml2, N/A and missing properties yield NaN
+                source['property_name'] = None
+                source['property_selector'] = compile_xpath('number(%s)' % source['property_selector'])
+
+
+# Everything extraction needs from a metric source, resolved once at import
+MetricMember = collections.namedtuple('MetricMember', [
+    'type', 'name', 'description', 'properties_filter', 'label_names', 'label_properties', 'label_values',
+    'property_name', 'property_selector'])
+
+
+def group_metrics(metrics):
+    """ Group metric sources by API path, then by object selector, so that
+        each set of objects is selected once per scrape and shared by every
+        metric reading from it.
+    """
+    groups = {}
+    for name, metric in metrics.items():
+        for source in metric['sources']:
+            selectors = groups.setdefault(source['path'], {})
+            object_selector = source['object_selector']
+            _, members = selectors.setdefault(object_selector.path, (object_selector, []))
+            # Members are flattened to tuples so that extraction unpacks locals
+            # instead of looking up the metric and source dicts for each sample
+            members.append(MetricMember(metric['type'], PREFIX + name, metric['description'],
+                                        source['properties_filter'], source['label_names'],
+                                        source['label_properties'], source['label_values'],
+                                        source['property_name'], source['property_selector']))
+    return groups
+
+
+compile_metrics(METRICS)
+METRIC_GROUPS = group_metrics(METRICS)
+FETCHED_PATHS = ['version'] + list(METRIC_GROUPS)
+
+
+def extract_samples(path, stream):
+    """ Stream-parse an API response and return the (type, name, description,
+        label names, label values, value) samples of its metrics, along with
+        its status codes.
+
+        Top-level objects are processed and dropped as soon as they are parsed,
+        so only one of them is held in memory at any time.
+    """
+    samples = []
+    status = []
+    groups = list(METRIC_GROUPS.get(path, {}).values())
+    is_version = path == 'version'
+    # Each top-level object is moved out of the parsed tree into this container
+    # so that selectors only match within it
+    root = lxml.etree.Element('RESPONSE')
+    for _, obj in lxml.etree.iterparse(stream, tag='OBJECT', **PARSER_OPTIONS):
+        if obj.getparent().getparent() is not None:
+            # Nested objects are handled along with their top-level object
+            continue
+        root.append(obj)
+
+        if obj.get('name') == 'status':
+            status.extend(STATUS_SELECTOR(root))
+
+        if is_version:
+            for controller in ['controller-a-versions', 'controller-b-versions' ]:
+                for version_obj in VERSION_OBJECT_SELECTOR(root, name=controller):
+                    label_values = [controller]
+                    for version in VERSION_PROPERTIES:
+                        label_values.append(str(VERSION_PROPERTY_SELECTOR(version_obj, name=version)[0].text))
+                    samples.append(('gauge', PREFIX + "version", "Firmware Versions", VERSION_LABEL_NAMES,
+                                    tuple(label_values), 1))
+
+        for object_selector, members in groups:
+            for match in object_selector(root):
+                # Index the properties in a single pass, every metric of the group reads from them
+                properties = {elem.get('name'): elem.text for elem in match if elem.tag == 'PROPERTY'}
+                for (metric_type, name, description, properties_filter, label_names, label_properties,
+                     label_values, property_name, property_selector) in members:
+                    if properties_filter and any(properties.get(prop) != expected
+                                                 for prop, expected in properties_filter):
+                        continue
+                    if label_properties:
+                        label_values = tuple(str(properties.get(prop)) for prop in label_properties) + label_values
+                    if property_name is not None:
+                        try:
+                            value = float(properties.get(property_name))
+                        except (TypeError, ValueError):
+                            # 'N/A' or missing property
+                            value = NAN
+                    else:
+                        value = property_selector(match)
+                    samples.append((metric_type, name, description, label_names, label_values, value))
+
+        root.remove(obj)
+
+    return samples, status
 
 class MetricStore(object):
+    """ Samples of a single scrape, exposed as Prometheus metric families.
+    """
+    __slots__ = ('metrics',)
+
     def __init__(self):
         self.metrics = {}
 
-    def get_or_create(self, metric_type, name, description, labels):
-        metric_key = (name, tuple(labels.keys()))
+    def add(self, metric_type, name, description, label_names, label_values, value):
+        metric_key = (name, label_names)
 
         if metric_key not in self.metrics:
-            if metric_type == 'gauge':
-                self.metrics[metric_key] = prometheus_client.Gauge(name, description, tuple(labels.keys()))
-            else:
-                raise RuntimeError('Unknown metric type "%s"' % metric_type)
+            self.metrics[metric_key] = (metric_type, description, {})
 
-        metric = self.metrics[metric_key]
+        # Like a Gauge, keep only the last value set for a given label set
+        self.metrics[metric_key][2][label_values] = value
 
-        if labels:
-            return metric.labels(**labels)
-        else:
-            return metric
+    def families(self):
+        for (name, label_names), (metric_type, description, samples) in self.metrics.items():
+            family = METRIC_TYPES[metric_type](name, description, labels=label_names)
+            for label_values, value in samples.items():
+                family.add_metric(label_values, value)
+            yield family
 
 
-def scrap_msa(metrics_store, host, login, password, timeout=10):
-    session = requests.Session()
-    session.verify = False
+class MsaCollector(object):
+    """ Prometheus collector exposing the metrics of the last MSA scrape.
 
-    creds = hashlib.sha256(b'%s_%s' % (login.encode('utf8'), password.encode('utf8'))).hexdigest()
-    response = session.get('https://%s/api/login/%s' % (host, creds), timeout=timeout)
-    response.raise_for_status()
-    session_key = ET.fromstring(response.content)[0][2].text
+        Without on_demand, scrap() must be called periodically to refresh the
+        metrics; with it, the MSA is scraped whenever Prometheus collects.
+    """
+    def __init__(self, scraper, on_demand=False):
+        self.scraper = scraper
+        self.on_demand = on_demand
+        self.families = []
 
-    session.headers['sessionKey'] = session_key
-    session.cookies['wbisessionkey'] = session_key
-    session.cookies['wbiusername'] = login
+    def scrap(self):
+        metrics_store = MetricStore()
+        self.scraper.scrap(metrics_store)
+        self.families = list(metrics_store.families())
 
-    path_cache = {}
+    def describe(self):
+        # Avoid a scrape when the collector is registered
+        return []
 
-# Firmware version
-    response = session.get('https://%s/api/show/version' % (host), timeout=timeout)
-    xml = lxml.etree.fromstring(response.content)
+    def collect(self):
+        if self.on_demand:
+            self.scrap()
+        return self.families
 
-    for controller in ['controller-a-versions', 'controller-b-versions' ]:
-        for obj in xml.xpath('./OBJECT[@name="%s"]'%controller):
-            labels = { "controller": controller }
-            for version in ["bundle-version", "bundle-base-version","sc-fw", "mc-fw", "pld-rev"]:
-                value = obj.find('./PROPERTY[@name="%s"]'%version).text
-                labels[version.replace("-", "_")] = value
-            metrics_store.get_or_create('gauge', PREFIX + "version", "Firmware Versions", labels).set(1)
 
-    for name, metric in METRICS.items():
-        name = PREFIX + name
-        if isinstance(metric['sources'], dict):
-            sources = [metric['sources']]
+class MsaScraper(object):
+    def __init__(self, host, login, creds, timeout=10, parallel=True):
+        self.host = host
+        self.login = login
+        self.timeout = timeout
+        self.parallel = parallel
+        self.login_url = 'https://%s/api/login/%s' % (host, creds)
+        self.urls = {path: 'https://%s/api/show/%s' % (host, path) for path in FETCHED_PATHS}
+
+        # The session and its key are kept across scrapes until the MSA rejects them
+        self.session = requests.Session()
+        self.session.verify = False
+        # The XML is highly redundant, ask for it compressed whatever the requests
+        # defaults; MSAs that ignore this simply send plain XML, which parses the same
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        # One kept-alive connection per concurrently fetched path
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1,
+                                                                     pool_maxsize=len(FETCHED_PATHS)))
+        self.session_key = None
+        self.login_lock = threading.Lock()
+
+        # Samples of endpoints which sent cache validators, by path
+        self.sample_cache = {}
+
+    def _login(self):
+        response = self.session.get(self.login_url, timeout=self.timeout)
+        response.raise_for_status()
+        xml = lxml.etree.fromstring(response.content, PARSER)
+        # On failure, the response holds an error message instead of a session key
+        if STATUS_SELECTOR(xml) != ['0']:
+            raise RuntimeError('Login failed: %s' % ''.join(SESSION_KEY_SELECTOR(xml)))
+        session_key = SESSION_KEY_SELECTOR(xml)[0]
+
+        self.session.headers['sessionKey'] = session_key
+        self.session.cookies['wbisessionkey'] = session_key
+        self.session.cookies['wbiusername'] = self.login
+        self.session_key = session_key
+
+    def _relogin(self, rejected_key):
+        # Concurrent fetches may all be rejected, only the first one logs in again
+        with self.login_lock:
+            if self.session_key == rejected_key:
+                self._login()
+
+    def fetch(self, path, retry=True):
+        """ Fetch an API path and return the samples extracted from it, along
+            with the number of bytes received and the time spent parsing them.
+        """
+        session_key = self.session_key
+
+        # Revalidate the cached samples, if any, instead of downloading the document again
+        cached = self.sample_cache.get(path)
+        headers = {}
+        if cached is not None:
+            etag, last_modified, samples = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = self.session.get(self.urls[path], headers=headers, timeout=self.timeout, stream=True)
+        if response.status_code in (401, 403, 304):
+            # Consume the (empty) body so the connection goes back to the pool
+            response.content
+        if response.status_code in (401, 403) and retry:
+            self._relogin(session_key)
+            return self.fetch(path, retry=False)
+        if response.status_code == 304 and cached is not None:
+            return samples, 0, 0.0
+        response.raise_for_status()
+        # Parse straight from the socket rather than buffering the whole body first,
+        # the parse time thus includes waiting for the MSA to send the document
+        response.raw.decode_content = True
+        start = time.monotonic()
+        samples, status = extract_samples(path, response.raw)
+        seconds = time.monotonic() - start
+        received = response.raw.tell()
+
+        # An expired session key is reported as an error status in the document
+        if status not in ([], ['0']) and retry:
+            self._relogin(session_key)
+            return self.fetch(path, retry=False)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            self.sample_cache[path] = (etag, last_modified, samples)
         else:
-            sources = metric['sources']
+            self.sample_cache.pop(path, None)
+        return samples, received, seconds
+
+    def scrap(self, metrics_store):
+        if self.session_key is None:
+            self._login()
 
-        for source in sources:
-            if source['path'] not in path_cache:
-                response = session.get('https://%s/api/show/%s' % (host, source['path']), timeout=timeout)
-                response.raise_for_status()
-                path_cache[source['path']] = lxml.etree.fromstring(response.content)
+        if self.parallel:
+            # Paths are independent, fetch them concurrently over the same session
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(FETCHED_PATHS)) as executor:
+                results = list(executor.map(self.fetch, FETCHED_PATHS))
+        else:
+            results = [self.fetch(path) for path in FETCHED_PATHS]
 
-            xml = path_cache[source['path']]
+        for path, (samples, received, seconds) in zip(FETCHED_PATHS, results):
+            for sample in samples:
+                metrics_store.add(*sample)
+            metrics_store.add('gauge', PREFIX + 'exporter_scrape_bytes',
+                              'Bytes received', ('path',), (path,), received)
+            metrics_store.add('gauge', PREFIX + 'exporter_parse_seconds',
+                              'Receive and parse time', ('path',), (path,), seconds)
 
-            for obj in xml.xpath(source['object_selector']):
-                labels = {source['properties_as_label'][elem.get('name')]: elem.text for elem in obj
-                          if elem.get('name') in source.get('properties_as_label', {})}
-                labels.update(source.get('labels', {}))
-                value = obj.find(source['property_selector']).text
-                if value == 'N/A' : value = 'nan'
-                metrics_store.get_or_create(metric.get('type', 'gauge'), name, metric['description'], labels).set(value)
+
+def profiled(function):
+    """ Wrap function so that each call prints its cProfile statistics,
+        sorted by cumulative time.
+    """
+    def wrapper(*args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            pstats.Stats(profile).sort_stats('cumulative').print_stats(30)
+    return wrapper
 
 
 if __name__ == '__main__':
@@ -869,22 +1116,42 @@ if __name__ == '__main__':
     parser.add_argument('login')
     parser.add_argument('password')
     parser.add_argument('-p', '--port', type=int, default=8000)
-    parser.add_argument('-i', '--interval', type=int, default=60)
+    parser.add_argument('-i', '--interval', type=int, default=60,
+                        help='seconds between scrapes, 0 to scrape whenever Prometheus collects')
     parser.add_argument('-t', '--timeout', type=int, default=60)
+    parser.add_argument('--profile', action='store_true',
+                        help='print cProfile statistics of each scrape, paths are then fetched sequentially')
 
     args = parser.parse_args()
 
     print("Starting MSA exporter on port %d" % args.port)
     print("Connecting to %s as %s" % (args.hostname, args.login))
-    print("Scraping every %d seconds with timeout %d seconds" % (args.interval, args.timeout))
+    if args.interval:
+        print("Scraping every %d seconds with timeout %d seconds" % (args.interval, args.timeout))
+    else:
+        print("Scraping on each collection with timeout %d seconds" % args.timeout)
 
     # disable urllib3 SSL warnings used by pyrequests
     urllib3.disable_warnings()
+    # Credentials never change, hash them once for all logins
+    creds = hashlib.sha256(b'%s_%s' % (args.login.encode('utf8'), args.password.encode('utf8'))).hexdigest()
+    # cProfile only sees the calling thread, so profiled scrapes do not use the fetch threads
+    scraper = MsaScraper(args.hostname, args.login, creds, timeout=args.timeout, parallel=not args.profile)
+    collector = MsaCollector(scraper, on_demand=not args.interval)
+    if args.profile:
+        collector.scrap = profiled(collector.scrap)
+    prometheus_client.REGISTRY.register(collector)
     prometheus_client.start_http_server(args.port)
-    metrics_store = MetricStore()
+    if not args.interval:
+        threading.Event().wait()
+    # Scrape at a fixed rate, whatever the time spent scraping
+    next_scrape = time.monotonic()
     while True:
         try:
-            scrap_msa(metrics_store, args.hostname, args.login, args.password, timeout=args.timeout)
+            collector.scrap()
         except:
             traceback.print_exc()
-        time.sleep(args.interval)
+        now = time.monotonic()
+        # A scrape slower than the interval delays the next one rather than piling up
+        next_scrape = max(next_scrape + args.interval, now)
+        time.sleep(next_scrape - now)